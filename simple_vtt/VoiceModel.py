@@ -5,11 +5,60 @@ Classes for extracting properties from a speaker in an audio clip.
 """
 
 import numpy as np
+import scipy.fft as spf
 import scipy.signal as sps
 
+# pyFFTW is optional -- when it's available we plan the STFT's FFT once and
+# reuse the plan every call, which beats numpy's FFT for repeated
+# fixed-size transforms. Without it we just fall back to np.fft.
+try:
+    import pyfftw
+    pyfftw.interfaces.cache.enable()
+except ImportError:
+    pyfftw = None
+
+# Numba is also optional -- it lets us fuse the framing and windowing into
+# a single parallel compiled pass instead of a chain of NumPy operations.
+try:
+    import numba
+except ImportError:
+    numba = None
+
 AUDIO_PROCESSING_WINDOW_SECONDS = 3
 AUDIO_PROCESSING_SAMPLE_HZ      = 8000
 
+# STFT framing parameters -- 50 ms segments with 50% overlap
+STFT_SEGMENT_SAMPLES = AUDIO_PROCESSING_SAMPLE_HZ // 20
+STFT_HOP_SAMPLES     = STFT_SEGMENT_SAMPLES // 2
+STFT_FRAME_COUNT     = ( AUDIO_PROCESSING_SAMPLE_HZ * AUDIO_PROCESSING_WINDOW_SECONDS
+                         - STFT_SEGMENT_SAMPLES ) // STFT_HOP_SAMPLES + 1
+STFT_BIN_COUNT       = STFT_SEGMENT_SAMPLES // 2 + 1
+
+def make_frame_kernel( nperseg, n_frames, hop ):
+    """Build a framing/windowing kernel specialized for one STFT shape.
+
+    Returns a compiled function filling out[i, :] = buf[i*hop :
+    i*hop+nperseg] * win, in parallel across frames -- equivalent to the
+    sliding_window_view + np.multiply pair in VoiceModel.stft(), but
+    fused into one pass. The shape parameters are baked in as closure
+    constants, so numba compiles loops with known trip counts (no shape
+    checks, full unrolling freedom) and the on-disk cache is keyed to
+    the exact specialization.
+
+    Returns None when numba isn't installed.
+    """
+    if numba is None:
+        return None
+
+    @numba.njit( parallel=True, fastmath=True, cache=True )
+    def frame_and_window( buf, win, out ):
+        for i in numba.prange( n_frames ):
+            start = i * hop
+            for j in range( nperseg ):
+                out[ i, j ] = buf[ start + j ] * win[ j ]
+
+    return frame_and_window
+
 class VoiceModel:
     """Analyze voice in an audio clip, in real-time.
 
@@ -31,7 +80,55 @@ class VoiceModel:
         Parameters
         ----------
         """
-        self.audio_buffer = np.zeros(AUDIO_PROCESSING_SAMPLE_HZ * AUDIO_PROCESSING_WINDOW_SECONDS)
+        # The buffer is circular -- self._write_index marks the next sample to be
+        # overwritten, which is also the oldest sample currently held.
+        # float32 everywhere -- it's what the sound hardware hands us, it's
+        # plenty of precision for audio, and it halves memory bandwidth
+        # through the whole buffer/FFT pipeline.
+        self.audio_buffer = np.zeros(AUDIO_PROCESSING_SAMPLE_HZ * AUDIO_PROCESSING_WINDOW_SECONDS, dtype=np.float32)
+        self._write_index = 0
+
+        # Scratch array that get_window() assembles the time-ordered view
+        # into, so repeated calls don't allocate a fresh window every time
+        self._window_scratch = np.empty_like( self.audio_buffer )
+
+        # The analysis window never changes, so build it once here rather
+        # than on every stft() call
+        self._stft_window = sps.windows.hann( STFT_SEGMENT_SAMPLES, sym=False ).astype( np.float32 )
+
+        # Fold scipy.signal.stft's default 'spectrum' scaling (divide by
+        # the window sum) into the cached window itself, so the rfft path
+        # returns the same magnitudes the old sps.stft call did without
+        # any extra per-call work
+        self._stft_window /= self._stft_window.sum()
+
+        # Plan the STFT's FFT once, if pyFFTW is around. The frame tensor
+        # shape never changes, so a single real-to-complex plan sized
+        # (frames, segment) can be reused for every stft() call.
+        if pyfftw is not None:
+            self._fft_in  = pyfftw.empty_aligned( ( STFT_FRAME_COUNT, STFT_SEGMENT_SAMPLES ), dtype="float32" )
+            self._fft_out = pyfftw.empty_aligned( ( STFT_FRAME_COUNT, STFT_BIN_COUNT ), dtype="complex64" )
+            self._fft = pyfftw.FFTW( self._fft_in, self._fft_out, axes=( -1, ),
+                                     flags=( "FFTW_MEASURE", ), threads=2 )
+        else:
+            # No plan, but keep a preallocated tensor for the windowed
+            # frames so the fallback path doesn't allocate per call either
+            self._fft_in = np.empty( ( STFT_FRAME_COUNT, STFT_SEGMENT_SAMPLES ), dtype=np.float32 )
+            self._fft = None
+
+        # Preallocated magnitude output, already in the (frame, bin)
+        # orientation the spectrogram display wants -- np.absolute writes
+        # into it rather than allocating a fresh array every transform
+        self._stft_magnitudes = np.empty( ( STFT_FRAME_COUNT, STFT_BIN_COUNT ), dtype=np.float32 )
+
+        # Framing kernel specialized to this model's exact STFT shape
+        # (None when numba isn't installed)
+        self._frame_kernel = make_frame_kernel( STFT_SEGMENT_SAMPLES, STFT_FRAME_COUNT, STFT_HOP_SAMPLES )
+
+        # The frequency and time axes depend only on module constants, so
+        # build them once here instead of on every stft() call
+        self._stft_freqs = spf.rfftfreq( STFT_SEGMENT_SAMPLES, 1.0 / AUDIO_PROCESSING_SAMPLE_HZ )
+        self._stft_times = np.arange( STFT_FRAME_COUNT ) * STFT_HOP_SAMPLES / AUDIO_PROCESSING_SAMPLE_HZ
 
     def process_audio_clip( self, samples, fs, contiguous=False ):
         """Fit to some additional audio.
@@ -55,21 +152,94 @@ class VoiceModel:
         if contiguous is False:
             raise NotImplementedError( "Sorry -- only contiguous data for now." )
 
-        # Roll the buffer backward, pushing the samples-to-be-overwritten to the front
-        # This is technically a lot of unneeded memory writes, but it keeps the buffer easy
-        # to work with and I think it will cut it for now
-        self.audio_buffer = np.roll(self.audio_buffer, len(samples))
-
-        # Overwrite the oldest samples (now at the front of the buffer) with the newest ones
-        self.audio_buffer[0: len(samples)] = samples[:,0]
+        # Write the new samples at the write index, splitting into two slice
+        # assignments if they wrap past the end of the buffer. Unlike the old
+        # np.roll() approach, this only touches len(samples) elements rather
+        # than rewriting the whole window on every callback.
+        new_samples = samples[:,0]
+        n = len( new_samples )
+        buffer_length = len( self.audio_buffer )
+        before_wrap = min( n, buffer_length - self._write_index )
+        self.audio_buffer[ self._write_index : self._write_index + before_wrap ] = new_samples[ :before_wrap ]
+        if before_wrap < n:
+            self.audio_buffer[ : n - before_wrap ] = new_samples[ before_wrap: ]
+        self._write_index = ( self._write_index + n ) % buffer_length
+
+    def get_window( self ):
+        """Return the processing window in contiguous time order
+
+        Materialize the circular audio buffer as a single contiguous
+        array, oldest sample first. This is the only place the full
+        window is copied, and it happens on demand rather than on every
+        audio callback.
+
+        The returned array is a preallocated scratch buffer owned by this
+        model -- it is overwritten by the next get_window() call, so copy
+        it if you need it to persist.
+        """
+        unwrapped = len( self.audio_buffer ) - self._write_index
+        self._window_scratch[ :unwrapped ] = self.audio_buffer[ self._write_index: ]
+        self._window_scratch[ unwrapped: ] = self.audio_buffer[ :self._write_index ]
+        return self._window_scratch
 
-    def stft( self ):
+    def stft( self, window=None ):
         """Calculate and return the short-time Fourier transform of the processing window
 
         This function calculates and returns the STFT of the audio
         processing window (the last AUDIO_PROCESSING_WINDOW_SECONDS of
         received audio).
 
-        The return format matches Scipy's stft() implementation.
+        Parameters
+        ----------
+        window : np.array( real ), optional
+            A contiguous, time-ordered snapshot of the processing window
+            to transform, as returned by get_window(). Callers running
+            off the thread that feeds process_audio_clip() should pass
+            their own copy here; when omitted, the live window is used.
+
+        Since the audio is real-valued, we use rfft() rather than a full
+        complex FFT -- the negative-frequency half would just be thrown
+        away anyway. Magnitudes are returned directly, already oriented
+        as (frame, frequency bin).
+
+        Returns
+        -------
+        freqs : np.array( real )
+            Center frequency of each STFT bin, in Hz
+        times : np.array( real )
+            Start time of each frame within the window, in seconds
+        magnitudes : np.array( real )
+            STFT magnitudes, shaped ( len( times ), len( freqs ) ).
+            Like get_window(), this is a preallocated array owned by the
+            model and overwritten by the next stft() call.
         """
-        return sps.stft(self.audio_buffer, fs=AUDIO_PROCESSING_SAMPLE_HZ, nperseg=AUDIO_PROCESSING_SAMPLE_HZ/20)
+        if window is None:
+            window = self.get_window()
+        if self._frame_kernel is not None:
+            # Fused, parallel framing + windowing via the shape-
+            # specialized compiled kernel
+            self._frame_kernel( window, self._stft_window, self._fft_in )
+        else:
+            # Frame the buffer without copying it -- sliding_window_view
+            # gives every possible segment as a strided view, and the
+            # hop-sized step selects the ones we actually transform. The
+            # window multiply writes straight into the preallocated FFT
+            # input, so the data lands contiguous for the batched kernel.
+            frames = np.lib.stride_tricks.sliding_window_view( window, STFT_SEGMENT_SAMPLES )[ ::STFT_HOP_SAMPLES ]
+            np.multiply( frames, self._stft_window, out=self._fft_in )
+
+        if self._fft is not None:
+            # Execute the cached FFTW plan over its input buffer
+            spectrum = self._fft()
+        else:
+            # scipy.fft's pocketfft backend, unlike scipy.signal.stft,
+            # carries none of the padding/detrend/inversion machinery --
+            # it's a straight batched transform over our frames, and it
+            # keeps float32 input in float32 rather than promoting.
+            # workers=-1 spreads the independent per-frame transforms
+            # across every core; pocketfft releases the GIL and keeps its
+            # worker pool warm between calls, so this pays off even for
+            # our small 400-point segments at 30 Hz.
+            spectrum = spf.rfft( self._fft_in, axis=-1, workers=-1 )
+        magnitudes = np.absolute( spectrum, out=self._stft_magnitudes )
+        return self._stft_freqs, self._stft_times, magnitudes
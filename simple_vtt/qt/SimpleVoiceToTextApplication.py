@@ -5,19 +5,30 @@ Backbone for this project's QT handling
 """
 
 # Batteries included
+import math
 import sys
-import threading
 
 # QT packages
 from PySide2 import QtCore, QtGui, QtWidgets
 import pyqtgraph as pg
 
 # audio IO
-import sounddevice as sd
+import rtmixer
 
 from simple_vtt.VoiceModel import *
 
-DEFAULT_SAMPLE_RATE = 8000
+# Ask PortAudio for the voice model's rate directly -- most backends will
+# resample in the driver, which keeps a whole conversion stage out of our
+# hot path entirely.
+DEFAULT_SAMPLE_RATE = AUDIO_PROCESSING_SAMPLE_HZ
+
+# Size of the capture ring buffer, in samples. Must be a power of two for
+# PortAudio's ring buffer implementation. It only needs to cover the
+# latency between drain ticks (~33 ms, i.e. a few hundred samples at
+# 8 kHz) -- a second's worth is already a generous margin, and keeping it
+# small keeps all the hot audio data cache-resident. Everything older
+# than the voice model's analysis window is simply discarded.
+RING_BUFFER_SAMPLES = 2 ** 13
 
 def getapp():
     """Convenience method to retrieve the QApplication singleton
@@ -36,53 +47,93 @@ class SimpleVoiceToTextApplication( QtWidgets.QApplication ):
         Parameters
         ----------
         mic_fs : int
-            The sample rate to use with the microphone, in Hz. Defaults to 44.1 KHz
+            The sample rate to use with the microphone, in Hz. Defaults
+            to the voice model's processing rate so that no resampling
+            is needed; any other rate is resampled on the way in.
         """
         super( SimpleVoiceToTextApplication, self ).__init__(sys.argv)
 
         # Grab params from keyword args
         self.mic_fs = mic_fs
 
-        # Create the voice model & a semaphore to protect it
+        # If the driver couldn't be asked for the model's rate, fall back
+        # to polyphase resampling in the drain path. Reduce the ratio up
+        # front so resample_poly runs with the smallest possible factors.
+        if self.mic_fs != AUDIO_PROCESSING_SAMPLE_HZ:
+            divisor = math.gcd( AUDIO_PROCESSING_SAMPLE_HZ, self.mic_fs )
+            self._resample_up   = AUDIO_PROCESSING_SAMPLE_HZ // divisor
+            self._resample_down = self.mic_fs // divisor
+        else:
+            self._resample_up = self._resample_down = None
+
+        # Running count of samples fed to the voice model, used to skip
+        # repaints when nothing new has actually arrived
+        self.samples_captured = 0
+        self._samples_at_last_draw = 0
+
+        # Create the voice model
+        # No lock is needed here -- the model is only ever touched from the
+        # Qt thread, which drains the capture ring buffer itself.
         self.voice_model = VoiceModel()
-        self.voice_model_semaphore = threading.Lock()
 
         # Create the main window
         self.main_window = MainWindow()
 
         # Open the sound device & start it
-        # blocksize parameter needs to be sufficiently high to avoid ALSA underrun conditions
+        # rtmixer's C callback writes straight into a PortAudio ring buffer,
+        # so no Python runs (and no GIL is taken) on the realtime thread.
+        # That also means we no longer need the big blocksize that was
+        # papering over ALSA underruns with the Python callback.
         # Mono audio for now
-        self.mic = sd.InputStream(samplerate=self.mic_fs,
-                                  blocksize=int( mic_fs/31),
-                                  channels=1,
-                                  callback=self._onSoundSamplesReceived)
+        self.mic = rtmixer.Recorder(samplerate=self.mic_fs,
+                                    blocksize=0,
+                                    channels=1)
+        self.ring_buffer = rtmixer.RingBuffer(self.mic.samplesize, RING_BUFFER_SAMPLES)
         self.mic.start()
+        self.record_action = self.mic.record_ringbuffer(self.ring_buffer)
 
         # Start the redraw timer at 30 FPS
         self.redraw_timer = QtCore.QTimer()
         self.redraw_timer.timeout.connect( self._redraw )
         self.redraw_timer.start( int( 1000.0 / 30 ) )
 
-    def _onSoundSamplesReceived( self, indata, frames, time, status ):
-        """Callback for our sounddevice.Stream()
-
-        The API for this function is defined by the sounddevice
-        libraries, and documented here:
-            https://python-sounddevice.readthedocs.io/en/0.4.3/api/streams.html#sounddevice.Stream
-
-        This implementation just copies the newest samples into our
-        sample buffer. A semaphore is employed to prevent the redraw
-        timer from blitting a half-updated buffer.
+    def _drainRingBuffer( self ):
+        """Pull any queued microphone samples into the voice model
+
+        Read everything the audio callback has committed to the ring
+        buffer since the last tick and feed it to the voice model.
+
+        There is deliberately no lock anywhere on this path. The ring
+        buffer is single-producer (rtmixer's C callback) single-consumer
+        (us, on the Qt thread), and PortAudio's implementation
+        synchronizes the pair with atomic read/write indices and memory
+        barriers: the producer publishes samples by advancing the write
+        index with a release store, and read_available only ever exposes
+        the committed range. A mutex here would put the realtime audio
+        thread at the mercy of UI-thread scheduling (priority inversion),
+        which is exactly what the old callback-plus-semaphore design
+        suffered from.
         """
-
-        # We don't need the frames parameter, but we'll check it anyway
-        assert(indata.shape[0] == frames)
-
-        # Update the voice model
-        self.voice_model_semaphore.acquire()
-        self.voice_model.process_audio_clip( indata, self.mic_fs, contiguous=True )
-        self.voice_model_semaphore.release()
+        # Collect everything first -- the ring buffer can hand the queued
+        # audio back in several pieces (at minimum two around the buffer's
+        # wrap point), and feeding the model once with the lot amortizes
+        # the resampling and circular-buffer bookkeeping over the tick
+        # instead of paying it per piece.
+        chunks = []
+        while self.ring_buffer.read_available:
+            raw = self.ring_buffer.read()
+            chunks.append( np.frombuffer( raw, dtype=np.float32 ) )
+        if not chunks:
+            return
+
+        samples = np.concatenate( chunks ).reshape( -1, 1 )
+        if self._resample_up is not None:
+            # Mic rate differs from the model's -- polyphase resample,
+            # which costs O(N * filter length) rather than scaling
+            # with the raw sample rate
+            samples = sps.resample_poly( samples, self._resample_up, self._resample_down, axis=0 ).astype( np.float32 )
+        self.voice_model.process_audio_clip( samples, AUDIO_PROCESSING_SAMPLE_HZ, contiguous=True )
+        self.samples_captured += len( samples )
 
     def _redraw(self):
         """Update the displayed waveform
@@ -93,10 +144,53 @@ class SimpleVoiceToTextApplication( QtWidgets.QApplication ):
         size), which is probably a fair bit faster than needed here.
         """
 
-        # Safely grab a copy of the current buffer
-        self.voice_model_semaphore.acquire()
+        # Consume new audio, then repaint -- unless nothing arrived, in
+        # which case the plots would come out pixel-identical and the
+        # whole repaint can be skipped
+        self._drainRingBuffer()
+        if self.samples_captured == self._samples_at_last_draw:
+            return
+        self._samples_at_last_draw = self.samples_captured
         self.main_window.redraw()
-        self.voice_model_semaphore.release()
+
+class StftWorkerSignals( QtCore.QObject ):
+    """Signal holder for StftWorker
+
+    QRunnable can't declare signals itself (it isn't a QObject), so the
+    worker carries one of these instead.
+    """
+    finished = QtCore.Signal( object, object, object )
+
+class StftWorker( QtCore.QRunnable ):
+    """Compute one STFT off the UI thread
+
+    Runs VoiceModel.stft() over a snapshot of the processing window on a
+    QThreadPool thread, then emits the result back to the UI thread for
+    blitting.
+    """
+
+    def __init__( self, voice_model, window_snapshot ):
+        """
+        Initialize a new StftWorker.
+
+        Parameters
+        ----------
+        voice_model : VoiceModel
+            The model whose stft() we'll run
+        window_snapshot : np.array( real )
+            A private copy of the processing window -- the worker must
+            not read the live buffer, which the UI thread keeps writing
+        """
+        super( StftWorker, self ).__init__()
+        self.voice_model = voice_model
+        self.window_snapshot = window_snapshot
+        self.signals = StftWorkerSignals()
+
+    def run( self ):
+        """Do the transform and publish the result
+        """
+        freqs, times, magnitudes = self.voice_model.stft( window=self.window_snapshot )
+        self.signals.finished.emit( freqs, times, magnitudes )
 
 class MainWindow(QtWidgets.QMainWindow):
     """Main window for the Application
@@ -125,16 +219,49 @@ class MainWindow(QtWidgets.QMainWindow):
         self.plot_widget = pg.PlotWidget()
         self.plot_widget.setLabel( "left", "Air Pressure on Microphone Membrane" )
         self.plot_widget.setLabel( "bottom", "Time (seconds)" )
+
+        # No screen has a column per sample -- let pyqtgraph peak-decimate
+        # the waveform down to the visible pixel count before building the
+        # draw path, and skip anything scrolled out of view
+        self.plot_widget.setDownsampling( auto=True, mode="peak" )
+        self.plot_widget.setClipToView( True )
+
+        # The time axis always spans the model's processing window and the
+        # mic hands us normalized float32, so both ranges are known up
+        # front -- pin them and switch off auto-ranging so Qt isn't
+        # rescanning the data for bounds on every setData. Antialiasing
+        # buys nothing on a dense realtime trace and costs plenty.
+        self.plot_widget.setXRange( 0, AUDIO_PROCESSING_WINDOW_SECONDS, padding=0 )
+        self.plot_widget.setYRange( -1, 1, padding=0 )
+        self.plot_widget.disableAutoRange()
+        self.plot_widget.setAntialiasing( False )
         top_layout.addWidget(self.plot_widget)
         self.plot_item = None
 
+        # Time axis for the waveform plot -- the buffer length never
+        # changes, so this is computed once on the first redraw and reused
+        self._time_axis = None
+
         # Add the STFT plot
         self.stft_plot = pg.PlotWidget()
         self.stft_plot.setLabel( "bottom", "Time (seconds)" )
         self.stft_plot.setLabel( "left", "Frequency (Hz)" )
+        self.stft_plot.setAntialiasing( False )
         self.stft_item = None
         top_layout.addWidget(self.stft_plot)
 
+        # STFT computation happens on a pool thread; this flag makes sure
+        # only one transform is in flight at a time. A redraw tick that
+        # arrives while one is pending just skips the STFT -- dropping a
+        # frame beats queueing up stale work. Both touch points run on the
+        # UI thread, so a plain attribute is all the synchronization needed.
+        self._stft_in_flight = False
+
+        # Sample count at the last transform we kicked off -- until at
+        # least one hop of new audio has arrived, a fresh STFT can't
+        # produce a visibly different image, so don't bother computing it
+        self._samples_at_last_stft = 0
+
         # That's it -- we can display the ourselves now!
         self.show()
 
@@ -145,25 +272,58 @@ class MainWindow(QtWidgets.QMainWindow):
         """
 
         # Time-domain sample
-        audio_clip = getapp().voice_model.audio_buffer
-        x = np.linspace(0, len(audio_clip)/getapp().mic_fs, len(audio_clip))
+        # The x axis is cached -- reallocating an identical linspace every
+        # 33 ms was pure GC pressure on the UI thread
+        audio_clip = getapp().voice_model.get_window()
+        if self._time_axis is None:
+            self._time_axis = np.linspace( 0, len(audio_clip) / AUDIO_PROCESSING_SAMPLE_HZ,
+                                           len(audio_clip), dtype=np.float32 )
+        x = self._time_axis
         if self.plot_item is None:
             # Plot data item not yet created -- must be the first update
-            # Create it
-            self.plot_item = self.plot_widget.plot(x, audio_clip)
+            # Create it, with a cheap cosmetic pen
+            self.plot_item = self.plot_widget.plot(x, audio_clip,
+                                                   pen=pg.mkPen("w", width=1, cosmetic=True))
 
         else:
             # already have plot data item, update its data
-            self.plot_item.setData( x, audio_clip )
-
-        # STFT
-        freqs, times, img = getapp().voice_model.stft()
-        img = np.absolute( img ).T
+            # skipFiniteCheck: we know the buffer never contains NaN/inf,
+            # so don't make pyqtgraph scan for them every frame
+            self.plot_item.setData( x, audio_clip, skipFiniteCheck=True )
+
+        # STFT -- kick off a worker on the thread pool and return; the
+        # result is blitted by _onStftFinished when it lands. The worker
+        # gets its own copy of the window since the live buffer keeps
+        # being written under it. Skipped until at least one hop of new
+        # audio has accumulated, since the frame grid (and therefore the
+        # image) barely moves below that.
+        samples_captured = getapp().samples_captured
+        if ( not self._stft_in_flight
+             and samples_captured - self._samples_at_last_stft >= STFT_HOP_SAMPLES ):
+            self._stft_in_flight = True
+            self._samples_at_last_stft = samples_captured
+            worker = StftWorker( getapp().voice_model, audio_clip.copy() )
+            worker.signals.finished.connect( self._onStftFinished )
+            QtCore.QThreadPool.globalInstance().start( worker )
+
+    def _onStftFinished( self, freqs, times, img ):
+        """Blit a finished STFT image
+
+        Slot for StftWorker.signals.finished -- runs on the UI thread.
+        The magnitudes arrive already oriented as (time, frequency).
+        """
+        self._stft_in_flight = False
         if self.stft_item is None:
             self.stft_item = pg.ImageItem( img )
             self.stft_item.setColorMap(pg.colormap.getFromMatplotlib('rainbow'))
             self.stft_item.setLevels((0, 0.01))
             self.stft_item.scale( times[-1] / img.shape[0], freqs[-1] / img.shape[1])
             self.stft_plot.addItem( self.stft_item )
+
+            # The image extents never change after this, so pin the view
+            # and stop auto-ranging on every blit
+            self.stft_plot.setXRange( 0, times[-1], padding=0 )
+            self.stft_plot.setYRange( 0, freqs[-1], padding=0 )
+            self.stft_plot.disableAutoRange()
         else:
             self.stft_item.setImage(img, autoLevels=False)